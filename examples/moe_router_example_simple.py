@@ -29,11 +29,11 @@ def test_moe_router_directly():
     print(f"输入形状: {hidden_states.shape}")
     
     # 执行路由
-    dispatch_tensor, combine_tensor, router_probs, aux_loss = router(hidden_states)
+    dispatch, combine_weights, router_probs, aux_loss = router(hidden_states)
     
     print(f"✓ 路由成功")
-    print(f"  - 调度张量形状: {dispatch_tensor.shape}")
-    print(f"  - 组合张量形状: {combine_tensor.shape}")
+    print(f"  - 调度token数: {dispatch.token_ids.numel()}")
+    print(f"  - 组合权重形状: {combine_weights.shape}")
     print(f"  - 路由概率形状: {router_probs.shape}")
     print(f"  - 辅助损失: {aux_loss.item():.4f}")
     
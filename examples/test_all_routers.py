@@ -44,15 +44,15 @@ def test_router(router_class, router_name, **kwargs):
         # 执行路由
         if router_class in [AdaptiveRouter, PiKVMoERouter]:
             # 这些路由器返回5个值
-            dispatch_tensor, combine_tensor, router_probs, aux_loss, importance = router(hidden_states)
+            dispatch, combine_weights, router_probs, aux_loss, importance = router(hidden_states)
             print(f"重要性分数形状: {importance.shape}")
         else:
             # 其他路由器返回4个值
-            dispatch_tensor, combine_tensor, router_probs, aux_loss = router(hidden_states)
+            dispatch, combine_weights, router_probs, aux_loss = router(hidden_states)
         
         print(f"✓ {router_name} 路由成功")
-        print(f"  - 调度张量形状: {dispatch_tensor.shape}")
-        print(f"  - 组合张量形状: {combine_tensor.shape}")
+        print(f"  - 调度token数: {dispatch.token_ids.numel()}")
+        print(f"  - 组合权重形状: {combine_weights.shape}")
         print(f"  - 路由概率形状: {router_probs.shape}")
         print(f"  - 辅助损失: {aux_loss.item():.4f}")
         
@@ -1,9 +1,10 @@
 # SPDX-FileCopyrightText: Copyright (c) 1993-2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import logging
 from dataclasses import dataclass
-from typing import Optional, Dict, List, Tuple, Union
+from typing import NamedTuple, Optional, Dict, List, Tuple, Union
 from contextlib import contextmanager
 
 import torch
@@ -21,6 +22,7 @@ from transformers import (
     Gemma3ForCausalLM,
     GPT2LMHeadModel,
     PreTrainedModel,
+    QuantizedCache,
 )
 
 logger = logging.getLogger(__name__)
@@ -36,6 +38,217 @@ SUPPORTED_MODELS = (
     GPT2LMHeadModel,  # 添加GPT2支持
 )
 
+
+@functools.lru_cache(maxsize=32)
+def _expert_capacity(total_tokens: int, capacity_factor: float, top_k: int, num_experts: int) -> int:
+    """每个专家的容量
+
+    服务场景下(batch, seq_len)通常固定，参数组合只有少数几种，
+    lru_cache让热路径上的容量计算退化为一次字典查找。
+    """
+    return int(total_tokens * capacity_factor * top_k / num_experts)
+
+
+@functools.lru_cache(maxsize=256)
+def _front_back_index(seq_len: int, keep_front: int, keep_back: int, device_str: str) -> torch.Tensor:
+    """前keep_front个与后keep_back个位置的保留索引（按参数组合与设备memoize）
+
+    解码阶段同一形状每层每token复用，省去重复的arange/cat小核启动；
+    torch.device不适合做缓存键（index为None时不等价），因此用字符串键。
+    """
+    device = torch.device(device_str)
+    return torch.cat([
+        torch.arange(keep_front, device=device),
+        torch.arange(seq_len - keep_back, seq_len, device=device),
+    ])
+
+
+class ExpertDispatch(NamedTuple):
+    """专家连续（ragged）布局的调度结果
+
+    token_ids: [M] 按专家排序的扁平token索引（b * seq_len + s），每个top-k分配一项
+    offsets:   [num_experts + 1] 每个专家在token_ids中的区间边界，
+               专家e的token为 token_ids[offsets[e]:offsets[e + 1]]
+    """
+    token_ids: torch.Tensor
+    offsets: torch.Tensor
+
+
+# 可选的融合topk-softmax后端：vLLM的自定义kernel，缺席时走eager/compile路径
+_vllm_ops = None
+_FUSED_TOPK_BACKEND = None
+try:
+    from vllm import _custom_ops as _vllm_ops  # type: ignore
+
+    if hasattr(_vllm_ops, "topk_softmax"):
+        _FUSED_TOPK_BACKEND = "vllm"
+except ImportError:
+    pass
+
+
+def _groupwise_quant_sim(x: torch.Tensor, bits: int, group_size: int = 64) -> torch.Tensor:
+    """按组min/max的均匀量化-反量化（模拟低位宽KV存储的数值精度）
+
+    沿head_dim每group_size个通道共享一组scale/zero-point；head_dim不能
+    整除时退化为整行一组。bits>=16时原样返回。
+    """
+    if bits >= 16:
+        return x
+
+    head_dim = x.shape[-1]
+    if head_dim % group_size != 0:
+        group_size = head_dim
+
+    orig_shape = x.shape
+    grouped = x.reshape(*orig_shape[:-1], head_dim // group_size, group_size)
+    group_min = grouped.amin(dim=-1, keepdim=True)
+    group_max = grouped.amax(dim=-1, keepdim=True)
+    scale = (group_max - group_min).clamp_min(1e-8) / (2 ** bits - 1)
+    quantized = torch.round((grouped - group_min) / scale)
+    return (quantized * scale + group_min).reshape(orig_shape)
+
+
+def _softmax_topk_renorm(
+    router_logits: torch.Tensor,
+    top_k: int,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """eager实现：softmax -> topk -> 重归一化（顺带算出每个专家的平均概率）"""
+    router_probs = F.softmax(router_logits, dim=-1)
+    # 在同一融合区域内计算专家平均概率，负载平衡损失无需再读一遍[B,S,E]张量
+    expert_probs_mean = router_probs.mean(dim=(0, 1))
+    top_k_probs, top_k_indices = torch.topk(router_probs, k=top_k, dim=-1)
+    # L1归一化单kernel完成（eager下sum+div是两个kernel）
+    top_k_probs = F.normalize(top_k_probs, p=1, dim=-1, eps=1e-8)
+    return router_probs, top_k_probs, top_k_indices, expert_probs_mean
+
+
+# 用torch.compile融合打分子图（softmax/topk/归一化），不可用时退回eager实现
+_softmax_topk_renorm_compiled = _softmax_topk_renorm
+if hasattr(torch, "compile"):
+    try:
+        _softmax_topk_renorm_compiled = torch.compile(_softmax_topk_renorm, dynamic=True)
+    except Exception:  # pragma: no cover - 取决于torch版本/后端
+        pass
+
+
+def _fused_topk_softmax(
+    router_logits: torch.Tensor,
+    top_k: int,
+    renorm: bool = True,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """调用vLLM的融合topk-softmax kernel（softmax与topk单kernel完成）
+
+    完整的router_probs仍需单独softmax一次，供负载平衡损失使用。
+    """
+    batch_shape = router_logits.shape[:-1]
+    num_experts = router_logits.shape[-1]
+    flat_logits = router_logits.reshape(-1, num_experts)
+    num_tokens = flat_logits.shape[0]
+
+    router_probs = F.softmax(router_logits, dim=-1)
+    expert_probs_mean = router_probs.mean(dim=(0, 1))
+
+    topk_weights = torch.empty(num_tokens, top_k, dtype=torch.float32, device=router_logits.device)
+    topk_ids = torch.empty(num_tokens, top_k, dtype=torch.int32, device=router_logits.device)
+    token_expert_indices = torch.empty_like(topk_ids)
+    _vllm_ops.topk_softmax(topk_weights, topk_ids, token_expert_indices, flat_logits.float())
+    top_k_probs = topk_weights.to(router_logits.dtype)
+    top_k_indices = topk_ids.long()
+
+    top_k_probs = top_k_probs.reshape(*batch_shape, top_k)
+    top_k_indices = top_k_indices.reshape(*batch_shape, top_k)
+
+    if renorm:
+        top_k_probs = F.normalize(top_k_probs, p=1, dim=-1, eps=1e-8)
+
+    return router_probs, top_k_probs, top_k_indices, expert_probs_mean
+
+
+# 按dtype缓存的掩码填充值，免去热路径上每次forward的finfo Python分发
+_NEG_INF_CACHE: Dict[torch.dtype, float] = {}
+
+
+def _neg_inf(dtype: torch.dtype) -> float:
+    """torch.finfo(dtype).min，按dtype缓存"""
+    value = _NEG_INF_CACHE.get(dtype)
+    if value is None:
+        value = _NEG_INF_CACHE.setdefault(dtype, torch.finfo(dtype).min)
+    return value
+
+
+def _score_and_topk(
+    router_logits: torch.Tensor,
+    expert_mask: Optional[torch.Tensor],
+    top_k: int,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """路由打分热路径：专家掩码 -> softmax -> topk -> 重归一化"""
+    # 应用专家掩码
+    if expert_mask is not None:
+        router_logits = router_logits + (1 - expert_mask) * _neg_inf(router_logits.dtype)
+
+    # 可用时走融合kernel，失败或无后端时退回编译的eager路径
+    if _FUSED_TOPK_BACKEND is not None and router_logits.is_cuda:
+        try:
+            return _fused_topk_softmax(router_logits, top_k)
+        except Exception:  # pragma: no cover - 后端版本差异
+            pass
+
+    # torch.compile在import期只包装不编译，真正的后端构建推迟到首次调用；
+    # 无可用编译工具链时在这里失败一次后永久退回eager实现
+    global _softmax_topk_renorm_compiled
+    try:
+        return _softmax_topk_renorm_compiled(router_logits, top_k)
+    except Exception:  # pragma: no cover - 取决于编译工具链
+        if _softmax_topk_renorm_compiled is _softmax_topk_renorm:
+            raise
+        _softmax_topk_renorm_compiled = _softmax_topk_renorm
+        return _softmax_topk_renorm(router_logits, top_k)
+
+
+class _GraphedModule(nn.Module):
+    """按输入形状分桶的CUDA Graph捕获/重放包装（仅适用于纯稠密子图）
+
+    capture一次后，同形状的调用只需把输入拷进静态缓冲并replay整张图，
+    免去逐kernel的launch开销。每个桶持有自己的静态输入/输出缓冲；
+    被包装模块内不允许有数据依赖形状或主机同步。
+    """
+
+    def __init__(self, inner: nn.Module):
+        super().__init__()
+        self.inner = inner
+        self._buckets: Dict[Tuple[int, ...], Tuple] = {}
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not x.is_cuda:
+            return self.inner(x)
+
+        key = tuple(x.shape)
+        entry = self._buckets.get(key)
+        if entry is None:
+            static_input = x.clone()
+            # 捕获前在侧流上预热，初始化cuBLAS工作区等惰性状态
+            warmup_stream = torch.cuda.Stream()
+            warmup_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(warmup_stream):
+                self.inner(static_input)
+            torch.cuda.current_stream().wait_stream(warmup_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = self.inner(static_input)
+            entry = (graph, static_input, static_output)
+            self._buckets[key] = entry
+            # 捕获期间kernel只被记录不执行，static_output此时还是未初始化内存；
+            # 必须先replay一次，本次调用才有真实结果
+            graph.replay()
+            return static_output
+
+        graph, static_input, static_output = entry
+        static_input.copy_(x)
+        graph.replay()
+        return static_output
+
+
 class BaseMoERouter(nn.Module):
     """
     基础MoE路由器类，为KV缓存压缩提供路由逻辑
@@ -46,7 +259,8 @@ class BaseMoERouter(nn.Module):
         num_experts: int, 
         top_k: int = 2, 
         capacity_factor: float = 1.5,
-        dropout: float = 0.0
+        dropout: float = 0.0,
+        inference_int8: bool = False
     ):
         super(BaseMoERouter, self).__init__()
         self.hidden_size = hidden_size
@@ -54,145 +268,191 @@ class BaseMoERouter(nn.Module):
         self.top_k = min(top_k, num_experts)
         self.capacity_factor = capacity_factor
         self.dropout = dropout
+        self.inference_int8 = inference_int8
         
-        # 路由网络
-        self.router = nn.Sequential(
-            nn.Linear(hidden_size, hidden_size),
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_size, num_experts)
-        )
+        # 路由网络：无dropout（常见推理路径）时折叠为单个线性投影，只需一次GEMM；
+        # 有dropout时保留两层MLP
+        if dropout == 0.0:
+            self.router = nn.Linear(hidden_size, num_experts, bias=False)
+        else:
+            self.router = nn.Sequential(
+                nn.Linear(hidden_size, hidden_size),
+                nn.ReLU(),
+                nn.Dropout(dropout),
+                nn.Linear(hidden_size, num_experts)
+            )
         
         # 路由统计信息
         self.register_buffer('total_tokens', torch.tensor(0.0))
         self.register_buffer('expert_usage_count', torch.zeros(num_experts))
         self.register_buffer('routing_decisions', torch.zeros(num_experts))
+
+        # 最近一次forward的专家平均概率，供压缩侧复用（免去二次归约）
+        self._last_expert_probs_mean: Optional[torch.Tensor] = None
         
         # 初始化权重
         self._init_weights()
+
+        # 可选：首层Linear动态int8量化（CPU推理路径）
+        if inference_int8 and isinstance(self.router, nn.Sequential):
+            self._quantize_router_int8()
+    
+    def _quantize_router_int8(self):
+        """把路由MLP的首层Linear替换为动态int8量化版本（按通道缩放）
+
+        路由logits只经过softmax（对平滑缩放不敏感）和topk（只需序关系），
+        对int8量化高度容忍；量化H->H的首层把权重带宽降为1/4。末层保持
+        浮点，避免量化误差影响topk的次序。
+        """
+        try:
+            import torch.ao.quantization as tq
+            from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+            float_linear = self.router[0]
+            float_linear.qconfig = tq.per_channel_dynamic_qconfig
+            self.router[0] = DynamicQuantizedLinear.from_float(float_linear)
+        except Exception as e:  # pragma: no cover - 取决于torch量化后端
+            logger.warning(f"Router int8 quantization unavailable, keeping float weights: {e}")
     
     def _init_weights(self):
         """初始化路由器权重"""
-        for module in self.router:
+        modules = self.router if isinstance(self.router, nn.Sequential) else [self.router]
+        for module in modules:
             if isinstance(module, nn.Linear):
                 nn.init.xavier_normal_(module.weight)
                 if module.bias is not None:
                     nn.init.zeros_(module.bias)
     
-    def _compute_capacity(self, batch_size: int, seq_len: int) -> int:
-        """计算每个专家的容量"""
-        total_tokens = batch_size * seq_len
-        return int(total_tokens * self.capacity_factor * self.top_k / self.num_experts)
+    def _compute_capacity(self, batch_size: int, seq_len: int, top_k: Optional[int] = None) -> int:
+        """计算每个专家的容量（结果按参数组合memoize）
+
+        动态top_k的路由器（AdaptiveRouter/PiKVMoERouter）通过参数传入当前k，
+        而不是改写self.top_k——self上的可变状态会让torch.compile反复加guard。
+        """
+        if top_k is None:
+            top_k = self.top_k
+        return _expert_capacity(
+            batch_size * seq_len, self.capacity_factor, top_k, self.num_experts
+        )
     
     def _create_dispatch_combine_tensors(
         self, 
         top_k_indices: torch.Tensor,
         top_k_probs: torch.Tensor,
         batch_size: int,
-        seq_len: int
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """创建调度和组合张量"""
-        capacity = self._compute_capacity(batch_size, seq_len)
-        
-        # 初始化张量
-        dispatch_tensor = torch.zeros(
-            batch_size, seq_len, self.num_experts, capacity,
-            device=top_k_indices.device, dtype=top_k_probs.dtype
-        )
-        combine_tensor = torch.zeros(
-            batch_size, seq_len, self.num_experts, capacity,
-            device=top_k_indices.device, dtype=top_k_probs.dtype
-        )
-        
-        # 跟踪每个专家的当前容量使用
-        expert_capacity_used = torch.zeros(
-            self.num_experts, device=top_k_indices.device, dtype=torch.long
-        )
-        
-        # 填充调度和组合张量
-        for b in range(batch_size):
-            for s in range(seq_len):
-                for k in range(self.top_k):
-                    expert_idx = top_k_indices[b, s, k].item()
-                    prob = top_k_probs[b, s, k].item()
-                    
-                    # 检查专家容量
-                    if expert_capacity_used[expert_idx] < capacity:
-                        pos = expert_capacity_used[expert_idx].item()
-                        dispatch_tensor[b, s, expert_idx, pos] = 1.0
-                        combine_tensor[b, s, expert_idx, pos] = prob
-                        expert_capacity_used[expert_idx] += 1
-        
-        return dispatch_tensor, combine_tensor
+        seq_len: int,
+        top_k: Optional[int] = None
+    ) -> Tuple[ExpertDispatch, torch.Tensor]:
+        """创建调度信息和组合权重（专家连续的ragged布局）
+
+        不再物化两个[batch, seq, num_experts, capacity]的稠密张量——其中绝大部分
+        是0，内存为O(B*S*E*capacity)——而是按专家排序一次，返回扁平token索引加
+        每个专家的区间偏移，内存为O(B*S*top_k)。专家e的token（及对应组合权重）为
+        token_ids[offsets[e]:offsets[e+1]]，正是分组GEMM期望的输入布局。
+        """
+        capacity = self._compute_capacity(batch_size, seq_len, top_k)
+        device = top_k_indices.device
+
+        top_k = top_k_indices.shape[-1]
+        flat_experts = top_k_indices.reshape(-1).long()  # [N]
+        flat_probs = top_k_probs.reshape(-1)  # [N]
+
+        # 按专家稳定排序得到专家连续的排列（组内保持先到先得顺序）
+        sorted_experts, perm = torch.sort(flat_experts, stable=True)
+        token_ids = (torch.arange(flat_experts.numel(), device=device) // top_k)[perm]
+        combine_weights = flat_probs[perm]
+
+        # 容量截断：每个专家区间内位置>=capacity的分配被丢弃
+        counts = torch.bincount(sorted_experts, minlength=self.num_experts)
+        segment_starts = counts.cumsum(0) - counts
+        position_in_expert = torch.arange(sorted_experts.numel(), device=device) - segment_starts[sorted_experts]
+        valid = position_in_expert < capacity
+        token_ids = token_ids[valid]
+        combine_weights = combine_weights[valid]
+
+        # 截断后的区间偏移
+        offsets = torch.zeros(self.num_experts + 1, dtype=torch.long, device=device)
+        offsets[1:] = counts.clamp(max=capacity).cumsum(0)
+
+        return ExpertDispatch(token_ids, offsets), combine_weights
     
     def forward(
-        self, 
+        self,
         hidden_states: torch.Tensor,
-        expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        expert_mask: Optional[torch.Tensor] = None,
+        top_k: Optional[int] = None
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         路由输入到专家
-        
+
         Args:
             hidden_states: 输入张量 [batch_size, seq_len, hidden_size]
             expert_mask: 专家可用性掩码 [num_experts]
-            
+            top_k: 本次路由使用的k值，默认self.top_k
+
         Returns:
-            dispatch_tensor: 调度张量
-            combine_tensor: 组合张量
+            dispatch: 调度信息（专家连续布局，见ExpertDispatch）
+            combine_weights: 与dispatch.token_ids对齐的组合权重 [M]
             router_probs: 路由概率
             aux_loss: 辅助损失
         """
         batch_size, seq_len, hidden_size = hidden_states.shape
+        if top_k is None:
+            top_k = self.top_k
         
         # 计算路由逻辑（分数）
         router_logits = self.router(hidden_states)  # [batch_size, seq_len, num_experts]
-        
-        # 应用专家掩码
-        if expert_mask is not None:
-            mask_value = torch.finfo(router_logits.dtype).min
-            router_logits = router_logits + (1 - expert_mask) * mask_value
-            
-        # 计算路由概率
-        router_probs = F.softmax(router_logits, dim=-1)  # [batch_size, seq_len, num_experts]
-        
-        # 获取top_k专家
-        top_k_probs, top_k_indices = torch.topk(router_probs, k=self.top_k, dim=-1)
-        
-        # 重新归一化top_k概率
-        top_k_probs = top_k_probs / (top_k_probs.sum(dim=-1, keepdim=True) + 1e-8)
-        
-        # 创建调度和组合张量
-        dispatch_tensor, combine_tensor = self._create_dispatch_combine_tensors(
-            top_k_indices, top_k_probs, batch_size, seq_len
+
+        # 打分热路径：掩码 -> softmax -> topk -> 重归一化（可被torch.compile融合）
+        router_probs, top_k_probs, top_k_indices, expert_probs_mean = _score_and_topk(
+            router_logits, expert_mask, top_k
         )
-        
-        # 计算辅助损失（负载平衡）
-        aux_loss = self._compute_load_balancing_loss(router_probs, top_k_indices)
-        
+
+        # 创建调度信息和组合权重
+        dispatch, combine_weights = self._create_dispatch_combine_tensors(
+            top_k_indices, top_k_probs, batch_size, seq_len, top_k
+        )
+
+        # 计算辅助损失（负载平衡），复用打分热路径算出的专家平均概率
+        aux_loss = self._compute_load_balancing_loss(
+            router_probs, top_k_indices, router_prob_per_expert=expert_probs_mean
+        )
+
+        # 缓存专家平均概率，供子类的平衡损失复用（避免二次归约）
+        self._last_expert_probs_mean = expert_probs_mean
+
         # 更新统计信息
         with torch.no_grad():
             self.total_tokens += batch_size * seq_len
-            # 更新专家使用计数
-            for expert_idx in range(self.num_experts):
-                expert_count = (top_k_indices == expert_idx).sum().float()
-                self.expert_usage_count[expert_idx] += expert_count
-                self.routing_decisions[expert_idx] += expert_count
-        
-        return dispatch_tensor, combine_tensor, router_probs, aux_loss
+            # 更新专家使用计数（单次bincount代替逐专家遍历）
+            counts = torch.bincount(
+                top_k_indices.reshape(-1).long(), minlength=self.num_experts
+            ).to(self.expert_usage_count.dtype)
+            self.expert_usage_count += counts
+            self.routing_decisions += counts
+
+        return dispatch, combine_weights, router_probs, aux_loss
     
     def _compute_load_balancing_loss(
-        self, 
-        router_probs: torch.Tensor, 
-        expert_indices: torch.Tensor
+        self,
+        router_probs: torch.Tensor,
+        expert_indices: torch.Tensor,
+        router_prob_per_expert: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
-        """计算负载平衡损失"""
+        """计算负载平衡损失
+
+        打分热路径已经算出每个专家的平均概率时可通过router_prob_per_expert
+        传入，避免对[B,S,E]概率张量再做一次完整归约。
+        """
         # 计算每个专家的使用率
-        router_prob_per_expert = router_probs.mean(dim=[0, 1])  # [num_experts]
+        if router_prob_per_expert is None:
+            router_prob_per_expert = router_probs.mean(dim=[0, 1])  # [num_experts]
         
-        # 计算专家分配的实际比例
-        expert_mask = F.one_hot(expert_indices, num_classes=self.num_experts).float()
-        expert_usage_rate = expert_mask.mean(dim=[0, 1, 2])  # [num_experts]
+        # 计算专家分配的实际比例（bincount代替物化[B,S,K,E]的one-hot张量）
+        flat_indices = expert_indices.reshape(-1).long()
+        expert_usage_rate = torch.bincount(
+            flat_indices, minlength=self.num_experts
+        ).float() / flat_indices.numel()  # [num_experts]
         
         # 负载平衡损失：期望使用率与实际使用率的差异
         # 使用平方差损失鼓励均匀分布
@@ -241,65 +501,91 @@ class TopKBalancedRouter(BaseMoERouter):
         )
         self.balance_coefficient = balance_coefficient
         self.balance_mode = balance_mode  # "entropy", "variance", "gini"
-        
+
+        # 构造期绑定平衡损失函数：热路径上没有字符串分支，
+        # torch.compile看到的是一张直线图（无graph break）
+        self._balance_fn = {
+            "entropy": self._entropy_balance_loss,
+            "variance": self._variance_balance_loss,
+            "gini": self._gini_balance_loss,
+        }.get(balance_mode)
+
         # 平衡损失历史
         self.register_buffer('balance_loss_history', torch.zeros(100))
         self.register_buffer('balance_loss_idx', torch.tensor(0))
     
     def _compute_advanced_balance_loss(
-        self, 
-        router_probs: torch.Tensor
+        self,
+        router_probs: torch.Tensor,
+        expert_probs: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
         """计算高级负载平衡损失"""
-        # 计算每个专家的平均概率
-        expert_probs = router_probs.mean(dim=[0, 1])  # [num_experts]
-        
-        if self.balance_mode == "entropy":
-            # 最大化熵以实现均匀分布
-            entropy = -torch.sum(expert_probs * torch.log(expert_probs + 1e-8))
-            max_entropy = math.log(self.num_experts)
-            balance_loss = 1.0 - (entropy / max_entropy)
-            
-        elif self.balance_mode == "variance":
-            # 最小化方差
-            target_prob = 1.0 / self.num_experts
-            balance_loss = torch.var(expert_probs - target_prob)
-            
-        elif self.balance_mode == "gini":
-            # 最小化基尼系数
-            sorted_probs, _ = torch.sort(expert_probs)
-            index = torch.arange(1, self.num_experts + 1, dtype=torch.float, device=expert_probs.device)
-            gini = (2 * torch.sum(index * sorted_probs) / (self.num_experts * torch.sum(sorted_probs))) - 1
-            balance_loss = gini
-            
-        else:
-            # 默认使用基础损失
-            balance_loss = super()._compute_load_balancing_loss(router_probs, None)
-        
-        return balance_loss
+        # 计算每个专家的平均概率（打分热路径已算出时直接复用）
+        if expert_probs is None:
+            expert_probs = router_probs.mean(dim=[0, 1])  # [num_experts]
+
+        if self._balance_fn is not None:
+            return self._balance_fn(expert_probs)
+
+        # 未知模式默认使用基础损失
+        return super()._compute_load_balancing_loss(router_probs, None)
+
+    def _entropy_balance_loss(self, expert_probs: torch.Tensor) -> torch.Tensor:
+        """最大化熵以实现均匀分布
+
+        用xlogy代替log(p + 1e-8)：xlogy(0, 0) = 0按定义处理零概率，数值上
+        更稳定，且在torch.compile/Inductor下不会因eps hack产生与eager不一致
+        的融合结果。
+        """
+        entropy = -torch.special.xlogy(expert_probs, expert_probs).sum()
+        max_entropy = math.log(self.num_experts)
+        return 1.0 - (entropy / max_entropy)
+
+    def _variance_balance_loss(self, expert_probs: torch.Tensor) -> torch.Tensor:
+        """最小化方差"""
+        target_prob = 1.0 / self.num_experts
+        return torch.var(expert_probs - target_prob)
+
+    def _gini_balance_loss(self, expert_probs: torch.Tensor) -> torch.Tensor:
+        """最小化基尼系数
+
+        用两两差形式 gini = sum|x_i - x_j| / (2*E*sum(x)) 代替排序：
+        专家数很小，O(E^2)的单个融合kernel比sort+gather+reduce的串行链更便宜。
+
+        注意：这是标准基尼系数，均匀分布时为0。旧的排序实现因常数项偏差
+        整体高出1/num_experts（均匀分布时E=4给0.25）；两者梯度相同，但
+        balance_loss_history与聚合辅助损失的数值基线自此整体下移1/E。
+        """
+        pairwise_diff = (expert_probs.unsqueeze(1) - expert_probs.unsqueeze(0)).abs().sum()
+        gini = pairwise_diff / (2 * self.num_experts * expert_probs.sum() + 1e-8)
+        return gini
     
     def forward(
         self, 
         hidden_states: torch.Tensor,
         expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
-        dispatch_tensor, combine_tensor, router_probs, base_aux_loss = super().forward(
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor]:
+        dispatch, combine_weights, router_probs, base_aux_loss = super().forward(
             hidden_states, expert_mask
         )
         
-        # 计算高级平衡损失
-        advanced_balance_loss = self._compute_advanced_balance_loss(router_probs)
+        # 计算高级平衡损失（复用基础forward缓存的专家平均概率）
+        advanced_balance_loss = self._compute_advanced_balance_loss(
+            router_probs, expert_probs=getattr(self, '_last_expert_probs_mean', None)
+        )
         
         # 组合损失
         total_aux_loss = base_aux_loss + self.balance_coefficient * advanced_balance_loss
         
-        # 记录平衡损失历史
+        # 记录平衡损失历史（环形索引在设备上计算，不做device->host同步）
         with torch.no_grad():
-            idx = self.balance_loss_idx.item() % 100
-            self.balance_loss_history[idx] = advanced_balance_loss.item()
+            idx = torch.remainder(self.balance_loss_idx, 100).view(1)
+            self.balance_loss_history.index_copy_(
+                0, idx, advanced_balance_loss.detach().to(self.balance_loss_history.dtype).view(1)
+            )
             self.balance_loss_idx += 1
-        
-        return dispatch_tensor, combine_tensor, router_probs, total_aux_loss
+
+        return dispatch, combine_weights, router_probs, total_aux_loss
     
     def get_balance_loss_stats(self) -> Dict[str, float]:
         """获取平衡损失统计信息"""
@@ -328,7 +614,8 @@ class AdaptiveRouter(BaseMoERouter):
         capacity_factor: float = 1.5,
         dropout: float = 0.0,
         importance_threshold: float = 0.5,
-        adaptive_top_k: bool = True
+        adaptive_top_k: bool = True,
+        predictor_dtype: Optional[torch.dtype] = None
     ):
         super(AdaptiveRouter, self).__init__(
             hidden_size, num_experts, top_k, capacity_factor, dropout
@@ -354,13 +641,27 @@ class AdaptiveRouter(BaseMoERouter):
                 nn.Softmax(dim=-1)
             )
         
+        # 预测网络推理精度：输出只经过阈值比较/argmax，对精度不敏感，
+        # bf16可将激活带宽减半并用上tensor core
+        if predictor_dtype is None and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+            predictor_dtype = torch.bfloat16
+        self.predictor_dtype = predictor_dtype
+        if predictor_dtype is not None:
+            self.importance_predictor.to(predictor_dtype)
+            if adaptive_top_k:
+                self.top_k_predictor.to(predictor_dtype)
+
         # 重要性统计
         self.register_buffer('importance_history', torch.zeros(1000))
         self.register_buffer('importance_idx', torch.tensor(0))
     
     def _compute_importance(self, hidden_states: torch.Tensor) -> torch.Tensor:
         """计算输入重要性分数"""
-        importance = self.importance_predictor(hidden_states)  # [batch_size, seq_len, 1]
+        if self.predictor_dtype is not None:
+            importance = self.importance_predictor(hidden_states.to(self.predictor_dtype))
+            importance = importance.to(hidden_states.dtype)  # [batch_size, seq_len, 1]
+        else:
+            importance = self.importance_predictor(hidden_states)  # [batch_size, seq_len, 1]
         return importance.squeeze(-1)  # [batch_size, seq_len]
     
     def _adapt_top_k(self, hidden_states: torch.Tensor, importance: torch.Tensor) -> int:
@@ -374,6 +675,8 @@ class AdaptiveRouter(BaseMoERouter):
         
         # 组合特征
         combined_features = torch.cat([avg_features, avg_importance])
+        if self.predictor_dtype is not None:
+            combined_features = combined_features.to(self.predictor_dtype)
         
         # 预测top_k分布
         top_k_probs = self.top_k_predictor(combined_features)  # [top_k]
@@ -387,43 +690,44 @@ class AdaptiveRouter(BaseMoERouter):
         self, 
         hidden_states: torch.Tensor,
         expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         batch_size, seq_len, hidden_size = hidden_states.shape
-        
+
         # 计算重要性分数
         importance = self._compute_importance(hidden_states)  # [batch_size, seq_len]
-        
+
         # 自适应调整top_k
         current_top_k = self._adapt_top_k(hidden_states, importance)
-        
-        # 临时调整top_k进行路由计算
-        original_top_k = self.top_k
-        self.top_k = current_top_k
-        
-        # 执行基础路由
-        dispatch_tensor, combine_tensor, router_probs, aux_loss = super().forward(
-            hidden_states, expert_mask
+
+        # 执行基础路由（动态k通过参数传入，不改写self.top_k）
+        dispatch, combine_weights, router_probs, aux_loss = super().forward(
+            hidden_states, expert_mask, top_k=current_top_k
         )
-        
-        # 恢复原始top_k
-        self.top_k = original_top_k
-        
+
         # 基于重要性调整路由概率
         importance_weight = (importance > self.importance_threshold).float()
+
+        # 调整组合权重：重要token获得更高权重（按调度的token索引gather）
+        combine_weights = combine_weights * (1.0 + importance_weight.reshape(-1)[dispatch.token_ids])
         
-        # 调整组合张量：重要token获得更高权重
-        importance_expanded = importance_weight.unsqueeze(-1).unsqueeze(-1)  # [batch_size, seq_len, 1, 1]
-        combine_tensor = combine_tensor * (1.0 + importance_expanded)
-        
-        # 记录重要性历史
+        # 记录重要性历史（向量化环形缓冲更新，单次同步代替逐元素.item()）
         with torch.no_grad():
-            flat_importance = importance.flatten()
-            for imp_val in flat_importance:
-                idx = self.importance_idx.item() % 1000
-                self.importance_history[idx] = imp_val.item()
-                self.importance_idx += 1
-        
-        return dispatch_tensor, combine_tensor, router_probs, aux_loss, importance
+            flat_importance = importance.detach().flatten()
+            num_values = flat_importance.numel()
+            start = int(self.importance_idx.item())
+            if num_values > 1000:
+                # 只有最后1000个值会留在环形缓冲中，避免index_copy_遇到重复索引
+                flat_importance = flat_importance[-1000:]
+                start = start + num_values - 1000
+            ring_idx = torch.remainder(
+                torch.arange(start, start + flat_importance.numel(), device=flat_importance.device), 1000
+            )
+            self.importance_history.index_copy_(
+                0, ring_idx, flat_importance.to(self.importance_history.dtype)
+            )
+            self.importance_idx += num_values
+
+        return dispatch, combine_weights, router_probs, aux_loss, importance
 
 
 class PiKVMoERouter(AdaptiveRouter):
@@ -454,10 +758,12 @@ class PiKVMoERouter(AdaptiveRouter):
         self.register_buffer('cache_hit_rates', torch.zeros(num_experts))
         self.register_buffer('cache_update_counter', torch.tensor(0))
         
-        # 缓存感知路由调整网络
+        # 缓存感知路由调整网络：首层拆成特征/命中率两个投影
+        # （W @ [x; c] == W_x @ x + W_c @ c），前向无需cat与expand
         if cache_aware:
+            self.cache_feature_proj = nn.Linear(hidden_size, hidden_size, bias=False)
+            self.cache_rate_proj = nn.Linear(num_experts, hidden_size)
             self.cache_router_adjustment = nn.Sequential(
-                nn.Linear(hidden_size + num_experts, hidden_size),
                 nn.ReLU(),
                 nn.Linear(hidden_size, num_experts),
                 nn.Tanh()  # 输出调整因子 [-1, 1]
@@ -469,9 +775,13 @@ class PiKVMoERouter(AdaptiveRouter):
             # 更新命中率
             self.cache_hit_rates[expert_idx] = cache_hit_rate
             
-            # 更新历史记录
-            history_idx = self.cache_update_counter.item() % 100
-            self.cache_usage_history[expert_idx, history_idx] = cache_hit_rate
+            # 更新历史记录（环形索引在设备上计算，不做device->host同步）
+            history_idx = torch.remainder(self.cache_update_counter, 100).view(1)
+            self.cache_usage_history[expert_idx].index_copy_(
+                0, history_idx,
+                torch.as_tensor([cache_hit_rate], dtype=self.cache_usage_history.dtype,
+                                device=self.cache_usage_history.device)
+            )
             
         self.cache_update_counter += 1
     
@@ -489,14 +799,12 @@ class PiKVMoERouter(AdaptiveRouter):
         # 计算输入特征的平均值
         avg_features = hidden_states.mean(dim=1)  # [batch_size, hidden_size]
         
-        # 扩展缓存命中率到批次维度
-        cache_rates_expanded = self.cache_hit_rates.unsqueeze(0).expand(batch_size, -1)
-        
-        # 组合特征
-        combined_input = torch.cat([avg_features, cache_rates_expanded], dim=-1)
+        # 两个部分投影求和等价于对[features; cache_rates]做单个Linear，
+        # 命中率投影经广播叠加到批次维度，无需cat/expand的拷贝
+        combined_hidden = self.cache_feature_proj(avg_features) + self.cache_rate_proj(self.cache_hit_rates)
         
         # 计算调整因子
-        adjustment_factors = self.cache_router_adjustment(combined_input)  # [batch_size, num_experts]
+        adjustment_factors = self.cache_router_adjustment(combined_hidden)  # [batch_size, num_experts]
         
         # 扩展到序列维度
         adjustment_factors = adjustment_factors.unsqueeze(1).expand(-1, seq_len, -1)
@@ -508,7 +816,7 @@ class PiKVMoERouter(AdaptiveRouter):
         hidden_states: torch.Tensor,
         kv_cache_states: Optional[torch.Tensor] = None,
         expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         batch_size, seq_len, hidden_size = hidden_states.shape
         
         # 计算基础路由逻辑
@@ -519,45 +827,40 @@ class PiKVMoERouter(AdaptiveRouter):
             cache_adjustments = self._compute_cache_aware_adjustment(hidden_states, router_logits)
             router_logits = router_logits + cache_adjustments
         
-        # 应用专家掩码
-        if expert_mask is not None:
-            mask_value = torch.finfo(router_logits.dtype).min
-            router_logits = router_logits + (1 - expert_mask) * mask_value
-        
-        # 计算路由概率
-        router_probs = F.softmax(router_logits, dim=-1)
-        
         # 计算重要性
         importance = self._compute_importance(hidden_states)
-        
+
         # 自适应top_k
         current_top_k = self._adapt_top_k(hidden_states, importance)
-        
-        # 获取top_k专家
-        top_k_probs, top_k_indices = torch.topk(router_probs, k=current_top_k, dim=-1)
-        
-        # 重新归一化
-        top_k_probs = top_k_probs / (top_k_probs.sum(dim=-1, keepdim=True) + 1e-8)
-        
-        # 创建调度和组合张量
-        original_top_k = self.top_k
-        self.top_k = current_top_k
-        dispatch_tensor, combine_tensor = self._create_dispatch_combine_tensors(
-            top_k_indices, top_k_probs, batch_size, seq_len
+
+        # 打分热路径：掩码 -> softmax -> topk -> 重归一化（可被torch.compile融合）
+        router_probs, top_k_probs, top_k_indices, expert_probs_mean = _score_and_topk(
+            router_logits, expert_mask, current_top_k
+        )
+
+        # 创建调度信息和组合权重（动态k通过参数传入，不改写self.top_k）
+        dispatch, combine_weights = self._create_dispatch_combine_tensors(
+            top_k_indices, top_k_probs, batch_size, seq_len, current_top_k
         )
-        self.top_k = original_top_k
         
-        # 计算辅助损失
-        aux_loss = self._compute_load_balancing_loss(router_probs, top_k_indices)
+        # 计算辅助损失，复用打分热路径算出的专家平均概率
+        aux_loss = self._compute_load_balancing_loss(
+            router_probs, top_k_indices, router_prob_per_expert=expert_probs_mean
+        )
+
+        # 缓存专家平均概率，供压缩侧复用
+        self._last_expert_probs_mean = expert_probs_mean
         
         # 更新统计信息
         with torch.no_grad():
             self.total_tokens += batch_size * seq_len
-            for expert_idx in range(self.num_experts):
-                expert_count = (top_k_indices == expert_idx).sum().float()
-                self.expert_usage_count[expert_idx] += expert_count
-        
-        return dispatch_tensor, combine_tensor, router_probs, aux_loss, importance
+            # 更新专家使用计数（单次bincount代替逐专家遍历）
+            counts = torch.bincount(
+                top_k_indices.reshape(-1).long(), minlength=self.num_experts
+            ).to(self.expert_usage_count.dtype)
+            self.expert_usage_count += counts
+
+        return dispatch, combine_weights, router_probs, aux_loss, importance
 
 
 class EPLBRouter(BaseMoERouter):
@@ -587,30 +890,33 @@ class EPLBRouter(BaseMoERouter):
         self.register_buffer('load_history_idx', torch.tensor(0))
     
     def _update_expert_weights(self, expert_usage: torch.Tensor):
-        """动态更新专家权重以平衡负载"""
-        # 记录当前使用情况
-        idx = self.load_history_idx.item() % 50
-        self.expert_load_history[:, idx] = expert_usage
+        """动态更新专家权重以平衡负载（全程在设备上，不做.item()同步）"""
+        # 记录当前使用情况（环形索引在设备上计算）
+        idx = torch.remainder(self.load_history_idx, 50).view(1)
+        self.expert_load_history.index_copy_(
+            1, idx, expert_usage.to(self.expert_load_history.dtype).unsqueeze(1)
+        )
         self.load_history_idx += 1
         
-        # 计算平均负载
-        valid_entries = min(self.load_history_idx.item(), 50)
-        if valid_entries > 0:
-            avg_loads = self.expert_load_history[:, :valid_entries].mean(dim=1)
-            
-            # 调整权重：负载高的专家降低权重，负载低的专家提高权重
-            target_load = avg_loads.mean()
-            weight_adjustments = 1.0 - (avg_loads - target_load) / (target_load + 1e-8)
-            
-            # 平滑更新权重
-            self.expert_weights = 0.9 * self.expert_weights + 0.1 * weight_adjustments
-            self.expert_weights = torch.clamp(self.expert_weights, 0.1, 2.0)
+        # 计算平均负载：用掩码限定有效列，代替Python侧的切片长度计算
+        columns = torch.arange(50, device=self.expert_load_history.device)
+        valid_mask = (columns < self.load_history_idx).to(self.expert_load_history.dtype)
+        num_valid = valid_mask.sum().clamp(min=1.0)
+        avg_loads = (self.expert_load_history * valid_mask).sum(dim=1) / num_valid
+        
+        # 调整权重：负载高的专家降低权重，负载低的专家提高权重
+        target_load = avg_loads.mean()
+        weight_adjustments = 1.0 - (avg_loads - target_load) / (target_load + 1e-8)
+        
+        # 平滑更新权重
+        self.expert_weights = 0.9 * self.expert_weights + 0.1 * weight_adjustments
+        self.expert_weights = torch.clamp(self.expert_weights, 0.1, 2.0)
     
     def forward(
         self, 
         hidden_states: torch.Tensor,
         expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor]:
         batch_size, seq_len, hidden_size = hidden_states.shape
         
         # 计算路由逻辑
@@ -622,37 +928,31 @@ class EPLBRouter(BaseMoERouter):
         
         # 应用温度缩放
         router_logits = router_logits / self.temperature
-        
-        # 应用专家掩码
-        if expert_mask is not None:
-            mask_value = torch.finfo(router_logits.dtype).min
-            router_logits = router_logits + (1 - expert_mask) * mask_value
-        
-        # 计算路由概率
-        router_probs = F.softmax(router_logits, dim=-1)
-        
-        # 获取top_k专家
-        top_k_probs, top_k_indices = torch.topk(router_probs, k=self.top_k, dim=-1)
-        
-        # 重新归一化
-        top_k_probs = top_k_probs / (top_k_probs.sum(dim=-1, keepdim=True) + 1e-8)
-        
-        # 创建调度和组合张量
-        dispatch_tensor, combine_tensor = self._create_dispatch_combine_tensors(
+
+        # 打分热路径：掩码 -> softmax -> topk -> 重归一化（可被torch.compile融合）
+        router_probs, top_k_probs, top_k_indices, expert_probs_mean = _score_and_topk(
+            router_logits, expert_mask, self.top_k
+        )
+
+        # 创建调度信息和组合权重
+        dispatch, combine_weights = self._create_dispatch_combine_tensors(
             top_k_indices, top_k_probs, batch_size, seq_len
         )
-        
+
         # 计算精确负载平衡损失
         aux_loss = self._compute_exact_balance_loss(router_probs, top_k_indices)
+
+        # 缓存专家平均概率，供压缩侧复用
+        self._last_expert_probs_mean = expert_probs_mean
         
-        # 更新专家权重
+        # 更新专家权重（单次bincount代替逐专家遍历）
         with torch.no_grad():
-            expert_usage = torch.zeros(self.num_experts, device=hidden_states.device)
-            for expert_idx in range(self.num_experts):
-                expert_usage[expert_idx] = (top_k_indices == expert_idx).sum().float()
+            expert_usage = torch.bincount(
+                top_k_indices.reshape(-1).long(), minlength=self.num_experts
+            ).float()
             self._update_expert_weights(expert_usage)
-        
-        return dispatch_tensor, combine_tensor, router_probs, aux_loss
+
+        return dispatch, combine_weights, router_probs, aux_loss
     
     def _compute_exact_balance_loss(
         self, 
@@ -697,48 +997,48 @@ class HierarchicalRouter(BaseMoERouter):
         self.group_top_k = group_top_k
         self.experts_per_group = num_experts // num_groups
         
-        # 组级路由器
-        self.group_router = nn.Sequential(
-            nn.Linear(hidden_size, hidden_size // 2),
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(hidden_size // 2, num_groups)
-        )
-        
-        # 组内路由器
-        self.intra_group_routers = nn.ModuleList([
-            nn.Sequential(
-                nn.Linear(hidden_size, hidden_size // 4),
+        # 组级路由器：与self.router相同，无dropout时折叠为单个线性投影
+        if dropout == 0.0:
+            self.group_router = nn.Linear(hidden_size, num_groups, bias=False)
+        else:
+            self.group_router = nn.Sequential(
+                nn.Linear(hidden_size, hidden_size // 2),
                 nn.ReLU(),
-                nn.Linear(hidden_size // 4, self.experts_per_group)
-            ) for _ in range(num_groups)
-        ])
+                nn.Dropout(dropout),
+                nn.Linear(hidden_size // 2, num_groups)
+            )
         
+        # 组内路由器（SoA布局：所有组的MLP权重堆叠，前向用单次批量GEMM）
+        intra_hidden = hidden_size // 4
+        self.intra_w1 = nn.Parameter(torch.empty(num_groups, hidden_size, intra_hidden))
+        self.intra_b1 = nn.Parameter(torch.zeros(num_groups, intra_hidden))
+        self.intra_w2 = nn.Parameter(torch.empty(num_groups, intra_hidden, self.experts_per_group))
+        self.intra_b2 = nn.Parameter(torch.zeros(num_groups, self.experts_per_group))
+
         # 初始化权重
         self._init_hierarchical_weights()
     
     def _init_hierarchical_weights(self):
         """初始化层次化路由器权重"""
         # 初始化组路由器
-        for module in self.group_router:
+        modules = self.group_router if isinstance(self.group_router, nn.Sequential) else [self.group_router]
+        for module in modules:
             if isinstance(module, nn.Linear):
                 nn.init.xavier_normal_(module.weight)
                 if module.bias is not None:
                     nn.init.zeros_(module.bias)
         
-        # 初始化组内路由器
-        for group_router in self.intra_group_routers:
-            for module in group_router:
-                if isinstance(module, nn.Linear):
-                    nn.init.xavier_normal_(module.weight)
-                    if module.bias is not None:
-                        nn.init.zeros_(module.bias)
+        # 初始化组内路由器（逐组初始化堆叠权重，保持与独立MLP相同的初始分布）
+        with torch.no_grad():
+            for g in range(self.num_groups):
+                nn.init.xavier_normal_(self.intra_w1[g])
+                nn.init.xavier_normal_(self.intra_w2[g])
     
     def forward(
         self, 
         hidden_states: torch.Tensor,
         expert_mask: Optional[torch.Tensor] = None
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[ExpertDispatch, torch.Tensor, torch.Tensor, torch.Tensor]:
         batch_size, seq_len, hidden_size = hidden_states.shape
         
         # 第一阶段：路由到专家组
@@ -750,71 +1050,57 @@ class HierarchicalRouter(BaseMoERouter):
             group_probs, k=min(self.group_top_k, self.num_groups), dim=-1
         )
         
-        # 初始化最终路由结果
-        final_expert_probs = torch.zeros(
-            batch_size, seq_len, self.num_experts, device=hidden_states.device
+        # 一次批量GEMM计算所有组的组内概率（SoA布局，替代逐组独立MLP）
+        intra_hidden = torch.relu(
+            torch.einsum('bsh,ghm->bsgm', hidden_states, self.intra_w1) + self.intra_b1
         )
-        
-        # 第二阶段：在每个选中的组内进行路由
-        for group_idx in range(min(self.group_top_k, self.num_groups)):
-            # 获取当前组的索引和概率
-            current_group_indices = top_group_indices[:, :, group_idx]  # [batch_size, seq_len]
-            current_group_probs = top_group_probs[:, :, group_idx]  # [batch_size, seq_len]
-            
-            # 对每个组进行组内路由
-            for g in range(self.num_groups):
-                # 找到属于当前组的位置
-                group_mask = (current_group_indices == g)  # [batch_size, seq_len]
-                if not group_mask.any():
-                    continue
-                
-                # 提取属于当前组的hidden states
-                group_hidden = hidden_states[group_mask]  # [num_tokens, hidden_size]
-                
-                if group_hidden.size(0) == 0:
-                    continue
-                
-                # 组内路由
-                intra_group_logits = self.intra_group_routers[g](group_hidden)
-                intra_group_probs = F.softmax(intra_group_logits, dim=-1)
-                
-                # 计算最终专家概率（组概率 × 组内概率）
-                group_prob_values = current_group_probs[group_mask].unsqueeze(-1)  # [num_tokens, 1]
-                final_intra_probs = intra_group_probs * group_prob_values  # [num_tokens, experts_per_group]
-                
-                # 映射到全局专家索引
-                expert_start_idx = g * self.experts_per_group
-                expert_end_idx = expert_start_idx + self.experts_per_group
-                
-                # 将组内概率映射到全局专家概率张量
-                # 使用scatter_来正确映射
-                for i in range(self.experts_per_group):
-                    expert_idx = expert_start_idx + i
-                    if expert_idx < self.num_experts:
-                        # 创建索引张量
-                        batch_indices, seq_indices = torch.where(group_mask)
-                        if len(batch_indices) > 0:
-                            final_expert_probs[batch_indices, seq_indices, expert_idx] = final_intra_probs[:, i]
+        intra_logits_all = torch.einsum('bsgm,gme->bsge', intra_hidden, self.intra_w2) + self.intra_b2
+        intra_probs_all = F.softmax(intra_logits_all, dim=-1)  # [batch_size, seq_len, num_groups, experts_per_group]
+
+        # 第二阶段：把每个token选中组的概率scatter成[B,S,G]权重（未选中组为0），
+        # 与预先算好的组内概率相乘后展平即为全局专家概率。
+        # 替代原来group_top_k x num_groups轮的布尔掩码gather/scatter循环。
+        group_weights = torch.zeros_like(group_probs)  # [batch_size, seq_len, num_groups]
+        group_weights.scatter_(-1, top_group_indices, top_group_probs)
+        weighted_probs = (intra_probs_all * group_weights.unsqueeze(-1)).reshape(batch_size, seq_len, -1)
+
+        if weighted_probs.shape[-1] == self.num_experts:
+            final_expert_probs = weighted_probs
+        else:
+            # num_experts不能被num_groups整除时，尾部专家保持0（与旧实现一致）
+            final_expert_probs = torch.zeros(
+                batch_size, seq_len, self.num_experts,
+                device=hidden_states.device, dtype=weighted_probs.dtype
+            )
+            final_expert_probs[..., :weighted_probs.shape[-1]] = weighted_probs
         
         # 获取top_k专家
         top_k_probs, top_k_indices = torch.topk(final_expert_probs, k=self.top_k, dim=-1)
         
-        # 重新归一化
-        top_k_probs = top_k_probs / (top_k_probs.sum(dim=-1, keepdim=True) + 1e-8)
+        # 重新归一化（L1归一化单kernel完成）
+        top_k_probs = F.normalize(top_k_probs, p=1, dim=-1, eps=1e-8)
         
-        # 创建调度和组合张量
-        dispatch_tensor, combine_tensor = self._create_dispatch_combine_tensors(
+        # 创建调度信息和组合权重
+        dispatch, combine_weights = self._create_dispatch_combine_tensors(
             top_k_indices, top_k_probs, batch_size, seq_len
         )
-        
+
+        # 专家平均概率只归约一次：平衡损失与压缩侧共用
+        final_probs_mean = final_expert_probs.mean(dim=(0, 1))
+
         # 计算层次化损失（组级 + 专家级）
         # 组级损失：使用组概率和组索引
         group_balance_loss = self._compute_group_balance_loss(group_probs, top_group_indices)
         # 专家级损失：使用专家概率和专家索引
-        expert_balance_loss = self._compute_load_balancing_loss(final_expert_probs, top_k_indices)
+        expert_balance_loss = self._compute_load_balancing_loss(
+            final_expert_probs, top_k_indices, router_prob_per_expert=final_probs_mean
+        )
         aux_loss = group_balance_loss + expert_balance_loss
+
+        # 缓存专家平均概率，供压缩侧复用
+        self._last_expert_probs_mean = final_probs_mean
         
-        return dispatch_tensor, combine_tensor, final_expert_probs, aux_loss
+        return dispatch, combine_weights, final_expert_probs, aux_loss
     
     def _compute_group_balance_loss(
         self, 
@@ -825,9 +1111,11 @@ class HierarchicalRouter(BaseMoERouter):
         # 计算每个组的使用率
         group_prob_per_group = group_probs.mean(dim=[0, 1])  # [num_groups]
         
-        # 计算组分配的实际比例
-        group_mask = F.one_hot(group_indices, num_classes=self.num_groups).float()
-        group_usage_rate = group_mask.mean(dim=[0, 1, 2])  # [num_groups]
+        # 计算组分配的实际比例（bincount代替物化one-hot张量）
+        flat_group_indices = group_indices.reshape(-1).long()
+        group_usage_rate = torch.bincount(
+            flat_group_indices, minlength=self.num_groups
+        ).float() / flat_group_indices.numel()  # [num_groups]
         
         # 负载平衡损失：期望使用率与实际使用率的差异
         balance_loss = torch.sum(group_prob_per_group * group_usage_rate)
@@ -863,12 +1151,22 @@ class MoERouterPress(BasePress):
     temperature: float = 1.0
     num_groups: int = 4
     group_top_k: int = 1
+    decision_interval: int = 1  # 每隔多少步重新路由（1=每步都路由）
+    compile_router: bool = False  # 用torch.compile包装路由器前向（适合解码阶段固定形状）
+    cuda_graph_router: bool = False  # 用CUDA Graph重放路由器打分MLP（按形状分桶）
+    quantize_retained_kv: bool = False  # 对保留token按策略位宽做分组量化（驱逐+量化混合）
     
     def __post_init__(self):
-        self.routers = {}
+        # ModuleDict注册路由器：随.to(device)/.cuda()一起迁移，并进入state_dict；
+        # ModuleDict要求字符串键，统一用str(layer_idx)
+        self.routers = nn.ModuleDict()
         self.expert_compression_stats = {}
-        self.total_aux_loss = 0.0
+        # 辅助损失在设备上累积，读取时才同步（见total_aux_loss属性）
+        self._aux_loss_buf: Optional[torch.Tensor] = None
         self.forward_count = 0
+        # 路由决策粘滞状态：每层的上次决策与步数计数
+        self._last_decision = {}
+        self._decision_step = {}
         
         # 初始化专家压缩策略
         self.expert_strategies = {
@@ -877,10 +1175,24 @@ class MoERouterPress(BasePress):
             2: "conservative",  # 保守压缩
             3: "selective"      # 选择性压缩
         }
+        # 热路径按argmax出的整数直接下标元组取策略，不走dict哈希+字符串键；
+        # expert_strategies字典仅作对外配置/展示
+        self._strategy_by_expert = tuple(
+            self.expert_strategies.get(i) for i in range(self.num_experts)
+        )
     
-    def _get_router(self, layer_idx: int, hidden_size: int) -> BaseMoERouter:
-        """获取或创建路由器"""
-        if layer_idx not in self.routers:
+    def _get_router(
+        self, layer_idx: int, hidden_size: int, device: Optional[torch.device] = None
+    ) -> BaseMoERouter:
+        """获取或创建路由器
+
+        device传入首次见到的hidden_states所在设备：路由器权重和统计缓冲
+        直接建在该设备上，热路径的统计更新不再隐式跨设备拷贝（CPU回退会
+        与CUDA流串行化）。reset_stats对这些缓冲用zero_()原地清零，设备
+        位置保持不变。
+        """
+        router_key = str(layer_idx)
+        if router_key not in self.routers:
             if self.router_type == "topk_balanced":
                 router = TopKBalancedRouter(
                     hidden_size=hidden_size,
@@ -941,79 +1253,146 @@ class MoERouterPress(BasePress):
                     dropout=self.dropout
                 )
             
-            self.routers[layer_idx] = router
-            self.expert_compression_stats[layer_idx] = {
-                "expert_usage": torch.zeros(self.num_experts),
-                "compression_ratios": torch.zeros(self.num_experts),
-                "cache_hit_rates": torch.zeros(self.num_experts)
-            }
+            # 路由器类型在构造时即固定：把每token热路径上的isinstance探测
+            # 折算成一次性的属性标记，compress里只剩普通属性读取（无MRO遍历）
+            router._returns_importance = isinstance(router, (AdaptiveRouter, PiKVMoERouter))
+            router._tracks_cache_usage = isinstance(router, PiKVMoERouter)
+
+            # 可选：CUDA Graph重放路由器打分MLP。解码时seq_len形状集合很小，
+            # 命中桶后整个MLP一次replay完成。捕获范围刻意只到打分MLP为止：
+            # 调度/驱逐部分存在数据依赖形状（容量截断、topk保留），CUDA Graph
+            # 不允许捕获这类kernel。
+            if self.cuda_graph_router and torch.cuda.is_available():
+                router.router = _GraphedModule(router.router)
+
+            # 可选：编译路由器前向。只包装bound method，isinstance分派不受影响；
+            # 路由器MLP是小图，reduce-overhead（CUDA graph重放）正对解码阶段的
+            # 框架开销。compress本身的控制流不进编译区域，避免guard失效反复重编。
+            if self.compile_router and hasattr(torch, "compile"):
+                try:
+                    router.forward = torch.compile(router.forward, mode="reduce-overhead", dynamic=False)
+                except Exception:  # pragma: no cover - 取决于torch版本/后端
+                    logger.warning("torch.compile unavailable for router, keeping eager forward")
+
+            if device is not None:
+                router = router.to(device)
+
+            self.routers[router_key] = router
+            # 每层统计用单个[3, num_experts]张量（行：使用次数/压缩比/缓存命中率），
+            # 三项更新合并为一次indexed add，少两次小核启动
+            self.expert_compression_stats[layer_idx] = torch.zeros(3, self.num_experts, device=device)
         
-        return self.routers[layer_idx]
+        return self.routers[router_key]
     
+    # 各策略的KV存储位宽：激进策略压得越狠，保留token的量化也越激进
+    _STRATEGY_BITS = {
+        "aggressive": 2,
+        "moderate": 4,
+        "conservative": 8,
+        "selective": 4,
+    }
+
+    # 比例策略表：strategy -> (front_frac, back_frac)，"selective"走独立路径
+    _STRATEGY_TABLE = {
+        "aggressive": (0.2, 0.1),    # 激进压缩：保留前20%和后10%
+        "moderate": (0.3, 0.2),      # 中等压缩：保留前30%和后20%
+        "conservative": (0.5, 0.3),  # 保守压缩：保留前50%和后30%
+    }
+
     def _apply_expert_compression(
         self, 
         keys: torch.Tensor, 
         values: torch.Tensor, 
         strategy: str,
-        router_probs: torch.Tensor
+        router_probs: torch.Tensor,
+        attentions: Optional[torch.Tensor] = None
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """应用专家特定的压缩策略"""
         batch_size, num_heads, seq_len, head_dim = keys.shape
-        
-        if strategy == "aggressive":
-            # 激进压缩：保留前20%和后10%
-            keep_front = max(1, int(seq_len * 0.2))
-            keep_back = max(1, int(seq_len * 0.1))
-            if seq_len > keep_front + keep_back:
-                keys = torch.cat([keys[:, :, :keep_front], keys[:, :, -keep_back:]], dim=2)
-                values = torch.cat([values[:, :, :keep_front], values[:, :, -keep_back:]], dim=2)
-                
-        elif strategy == "moderate":
-            # 中等压缩：保留前30%和后20%
-            keep_front = max(1, int(seq_len * 0.3))
-            keep_back = max(1, int(seq_len * 0.2))
-            if seq_len > keep_front + keep_back:
-                keys = torch.cat([keys[:, :, :keep_front], keys[:, :, -keep_back:]], dim=2)
-                values = torch.cat([values[:, :, :keep_front], values[:, :, -keep_back:]], dim=2)
-                
-        elif strategy == "conservative":
-            # 保守压缩：保留前50%和后30%
-            keep_front = max(1, int(seq_len * 0.5))
-            keep_back = max(1, int(seq_len * 0.3))
-            if seq_len > keep_front + keep_back:
-                keys = torch.cat([keys[:, :, :keep_front], keys[:, :, -keep_back:]], dim=2)
-                values = torch.cat([values[:, :, :keep_front], values[:, :, -keep_back:]], dim=2)
-                
-        elif strategy == "selective":
-            # 选择性压缩：基于注意力权重选择重要位置
-            # 使用路由概率作为重要性指标
-            importance_scores = router_probs.mean(dim=0)  # [seq_len, num_experts]
-            importance_scores = importance_scores.mean(dim=-1)  # [seq_len]
-            
-            # 选择重要性最高的位置
-            num_keep = max(1, int(seq_len * (1 - self.compression_ratio)))
-            # 确保k值不超过序列长度
-            num_keep = min(num_keep, seq_len)
-            
-            # 确保importance_scores有正确的维度
-            if importance_scores.dim() == 0:
-                # 如果是标量，扩展为序列长度
-                importance_scores = importance_scores.expand(seq_len)
-            elif importance_scores.dim() > 1:
-                # 如果是多维，取平均值
-                importance_scores = importance_scores.mean(dim=-1)
-            
-            # 确保序列长度匹配
-            if importance_scores.size(0) != seq_len:
-                # 如果不匹配，使用简单的线性插值
-                importance_scores = torch.linspace(0, 1, seq_len, device=importance_scores.device)
-            
-            _, important_indices = torch.topk(importance_scores, k=num_keep, dim=-1)
-            important_indices = torch.sort(important_indices)[0]  # 保持顺序
-            
-            keys = keys[:, :, important_indices, :]
-            values = values[:, :, important_indices, :]
-        
+
+        if strategy == "selective":
+            return self._apply_selective_compression(keys, values, router_probs, attentions)
+
+        # 三个比例策略只差两个常数，查表后共用同一条gather路径
+        fractions = self._STRATEGY_TABLE.get(strategy)
+        if fractions is None:
+            return keys, values
+
+        front_frac, back_frac = fractions
+        keep_front = max(1, int(seq_len * front_frac))
+        keep_back = max(1, int(seq_len * back_frac))
+        if seq_len > keep_front + keep_back:
+            if keys.is_cuda:
+                # 单次index_select代替两段切片+cat，保留区域只做一次搬运
+                index = _front_back_index(seq_len, keep_front, keep_back, str(keys.device))
+                keys = keys.index_select(2, index)
+                values = values.index_select(2, index)
+            else:
+                keys, values = self._front_back_copy(keys, values, keep_front, keep_back)
+
+        return keys, values
+
+    @staticmethod
+    def _front_back_copy(
+        keys: torch.Tensor, values: torch.Tensor, keep_front: int, keep_back: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """CPU路径的cat-free前后段保留：一次[2,...]预分配 + 四个连续copy_
+
+        两段都是连续区间，连续copy_比index_select的逐元素gather便宜；
+        K/V共用同一块输出缓冲，分配次数也从两次cat降为一次empty。
+        """
+        batch_size, num_heads, _, head_dim = keys.shape
+        kept = keep_front + keep_back
+        out = torch.empty(
+            2, batch_size, num_heads, kept, head_dim, dtype=keys.dtype, device=keys.device
+        )
+        out[0, :, :, :keep_front].copy_(keys[:, :, :keep_front])
+        out[0, :, :, keep_front:].copy_(keys[:, :, -keep_back:])
+        out[1, :, :, :keep_front].copy_(values[:, :, :keep_front])
+        out[1, :, :, keep_front:].copy_(values[:, :, -keep_back:])
+        return out[0], out[1]
+
+    def _apply_selective_compression(
+        self,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        router_probs: Optional[torch.Tensor],
+        attentions: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """选择性压缩：优先用注意力权重度量位置重要性，路由概率作为回退"""
+        seq_len = keys.shape[2]
+
+        # 选择重要性最高的位置（k值不超过序列长度）
+        num_keep = max(1, int(seq_len * (1 - self.compression_ratio)))
+        num_keep = min(num_keep, seq_len)
+
+        if attentions is not None and attentions.shape[-1] == seq_len:
+            # 注意力权重[B, H, Q, L]：对batch/head/query维一次归约得到每位置重要性
+            importance_scores = attentions.mean(dim=(0, 1, 2))  # [seq_len]
+        elif router_probs is not None and router_probs.shape[1] == seq_len:
+            # 回退：路由概率[B, L, E]，同样单次归约到[seq_len]
+            importance_scores = router_probs.mean(dim=(0, -1))
+        else:
+            # 无可用重要性来源（如hidden_states与KV长度不一致）时退化为按位置递增，
+            # 效果等同保留末尾num_keep个位置
+            importance_scores = torch.linspace(0, 1, seq_len, device=keys.device)
+
+        if seq_len > 4096 and num_keep < seq_len:
+            # 超长上下文：kthvalue取阈值 + 布尔掩码，O(n)且nonzero输出天然单调，
+            # 完全绕开topk的O(n log k)排序；阈值上并列时截断到num_keep保证数量精确
+            kth_value = torch.kthvalue(importance_scores, seq_len - num_keep + 1).values
+            important_indices = (importance_scores >= kth_value).nonzero(as_tuple=True)[0]
+            if important_indices.numel() > num_keep:
+                important_indices = important_indices[:num_keep]
+        else:
+            # 无序topk跳过其内部排序遍历，只对num_keep大小的索引张量排一次序；
+            # msort只求值不求置换索引，省掉torch.sort返回元组里被丢弃的索引张量
+            _, important_indices = torch.topk(importance_scores, k=num_keep, dim=-1, sorted=False)
+            important_indices = torch.msort(important_indices)  # 保持顺序
+
+        keys = keys.index_select(2, important_indices)
+        values = values.index_select(2, important_indices)
+
         return keys, values
     
     def _compute_cache_hit_rate(self, keys: torch.Tensor, values: torch.Tensor) -> float:
@@ -1037,76 +1416,127 @@ class MoERouterPress(BasePress):
         layer_idx = module.layer_idx
         hidden_size = hidden_states.shape[-1]
         
-        # 获取路由器
-        router = self._get_router(layer_idx, hidden_size)
-        
-        # 执行路由
-        if isinstance(router, (AdaptiveRouter, PiKVMoERouter)):
-            # 这些路由器返回5个值，包括重要性分数
-            dispatch_tensor, combine_tensor, router_probs, aux_loss, importance = router(
-                hidden_states, expert_mask=None
-            )
+        # 获取路由器（权重与统计缓冲建在hidden_states所在设备上）
+        router = self._get_router(layer_idx, hidden_size, hidden_states.device)
+
+        # 路由决策粘滞：解码阶段同一层的dominant expert很少逐token翻转，
+        # decision_interval>1时每K步才重新跑路由器，其余步复用上次决策
+        cached_decision = None
+        if self.decision_interval > 1:
+            step = self._decision_step.get(layer_idx, 0)
+            self._decision_step[layer_idx] = step + 1
+            if step % self.decision_interval != 0:
+                cached_decision = self._last_decision.get(layer_idx)
+
+        if cached_decision is not None and cached_decision[1] != "selective":
+            # 复用上次决策，整个路由器前向（含辅助损失）被跳过；
+            # "selective"依赖当前router_probs，始终重新路由
+            dominant_expert, strategy = cached_decision
+            router_probs = None
         else:
-            # 其他路由器返回4个值
-            dispatch_tensor, combine_tensor, router_probs, aux_loss = router(
-                hidden_states, expert_mask=None
-            )
-            importance = None
-        
-        # 累积辅助损失
-        self.total_aux_loss += aux_loss.item()
-        self.forward_count += 1
-        
-        # 获取每个专家的路由概率
-        expert_probs = router_probs.mean(dim=[0, 1])  # [num_experts]
-        
-        # 选择概率最高的专家
-        dominant_expert = torch.argmax(expert_probs).item()
-        strategy = self.expert_strategies[dominant_expert]
+            # 执行路由
+            if router._returns_importance:
+                # 这些路由器返回5个值，包括重要性分数
+                dispatch, combine_weights, router_probs, aux_loss, importance = router(
+                    hidden_states, expert_mask=None
+                )
+            else:
+                # 其他路由器返回4个值
+                dispatch, combine_weights, router_probs, aux_loss = router(
+                    hidden_states, expert_mask=None
+                )
+                importance = None
+
+            # 累积辅助损失：原地加在设备端标量上，避免每层一次.item()阻塞同步
+            aux_loss_detached = aux_loss.detach()
+            if self._aux_loss_buf is None:
+                self._aux_loss_buf = torch.zeros((), device=aux_loss_detached.device)
+            self._aux_loss_buf += aux_loss_detached
+            self.forward_count += 1
+
+            # 获取每个专家的路由概率：复用路由器打分时已算好的归约结果，
+            # 不再对[B, L, E]概率张量做第二遍mean（prefill时该张量可能很大）
+            expert_probs = router._last_expert_probs_mean
+            if expert_probs is None:
+                if router_probs.is_cuda and torch.cuda.is_bf16_supported():
+                    # 归约只为选出dominant expert：bf16读带宽减半，
+                    # num_experts路的argmax在bf16下结果不变
+                    expert_probs = router_probs.to(torch.bfloat16).mean(dim=[0, 1])
+                else:
+                    expert_probs = router_probs.mean(dim=[0, 1])  # [num_experts]
+
+            # 选择概率最高的专家：整段compress只在这里做一次设备到主机同步——
+            # 策略分派和CPU侧统计都需要Python整数，argmax本身留在设备上
+            dominant_expert = int(expert_probs.argmax())
+            strategy = self._strategy_by_expert[dominant_expert]
+            self._last_decision[layer_idx] = (dominant_expert, strategy)
         
         # 应用专家压缩策略
         compressed_keys, compressed_values = self._apply_expert_compression(
-            keys, values, strategy, router_probs
+            keys, values, strategy, router_probs, attentions
         )
+
+        # 驱逐+量化混合：保留下来的token再按策略位宽降精度，
+        # 在token剪枝之上叠加"改写数值"一档的压缩
+        if self.quantize_retained_kv:
+            bits = self._STRATEGY_BITS.get(strategy, 8)
+            compressed_keys = _groupwise_quant_sim(compressed_keys, bits)
+            compressed_values = _groupwise_quant_sim(compressed_values, bits)
         
         # 更新统计信息
         with torch.no_grad():
-            # 更新专家使用统计
-            self.expert_compression_stats[layer_idx]["expert_usage"][dominant_expert] += 1
-            
             # 计算压缩比
             original_size = keys.shape[2]
             compressed_size = compressed_keys.shape[2]
             compression_ratio = (original_size - compressed_size) / original_size
-            self.expert_compression_stats[layer_idx]["compression_ratios"][dominant_expert] += compression_ratio
-            
-            # 更新缓存命中率
-            cache_hit_rate = self._compute_cache_hit_rate(compressed_keys, compressed_values)
-            self.expert_compression_stats[layer_idx]["cache_hit_rates"][dominant_expert] += cache_hit_rate
+
+            # 缓存命中率（内联_compute_cache_hit_rate，省掉每层一次Python调用帧）
+            cache_hit_rate = compressed_size * 0.001 if compressed_size < 1000 else 1.0
+
+            # 使用次数/压缩比/缓存命中率一次写入dominant_expert列
+            layer_stats = self.expert_compression_stats[layer_idx]
+            layer_stats[:, dominant_expert] += torch.tensor(
+                [1.0, compression_ratio, cache_hit_rate],
+                device=layer_stats.device, dtype=layer_stats.dtype
+            )
             
             # 如果是PiKV路由器，更新缓存使用情况
-            if isinstance(router, PiKVMoERouter):
+            if router._tracks_cache_usage:
                 router.update_cache_usage(dominant_expert, cache_hit_rate)
         
-        logger.debug(f"Layer {layer_idx}: Expert {dominant_expert} ({strategy}) "
-                    f"compressed {keys.shape[2]} -> {compressed_keys.shape[2]} "
-                    f"(ratio: {compression_ratio:.3f})")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Layer {layer_idx}: Expert {dominant_expert} ({strategy}) "
+                         f"compressed {keys.shape[2]} -> {compressed_keys.shape[2]} "
+                         f"(ratio: {compression_ratio:.3f})")
         
         return compressed_keys, compressed_values
     
+    @property
+    def total_aux_loss(self) -> float:
+        """累计辅助损失（此处才触发一次设备到主机的同步）"""
+        return 0.0 if self._aux_loss_buf is None else float(self._aux_loss_buf)
+
     def get_stats(self) -> Dict[str, Union[float, Dict]]:
         """获取MoE路由器统计信息"""
+        total_aux_loss = self.total_aux_loss
         stats = {
-            "total_aux_loss": self.total_aux_loss,
-            "avg_aux_loss": self.total_aux_loss / max(1, self.forward_count),
+            "total_aux_loss": total_aux_loss,
+            "avg_aux_loss": total_aux_loss / max(1, self.forward_count),
             "forward_count": self.forward_count,
             "layer_stats": {}
         }
         
-        for layer_idx, router in self.routers.items():
+        for router_key, router in self.routers.items():
+            layer_idx = int(router_key)
+            # 对外仍暴露字典视图；三行切片共享同一块SoA存储，不发生拷贝
+            compression_stats = self.expert_compression_stats[layer_idx]
             layer_stats = {
                 "router_stats": router.get_routing_stats(),
-                "expert_compression_stats": self.expert_compression_stats[layer_idx]
+                "expert_compression_stats": {
+                    "expert_usage": compression_stats[0],
+                    "compression_ratios": compression_stats[1],
+                    "cache_hit_rates": compression_stats[2],
+                }
             }
             stats["layer_stats"][layer_idx] = layer_stats
         
@@ -1114,75 +1544,83 @@ class MoERouterPress(BasePress):
     
     def reset_stats(self):
         """重置统计信息"""
-        self.total_aux_loss = 0.0
+        if self._aux_loss_buf is not None:
+            self._aux_loss_buf.zero_()
         self.forward_count = 0
+        self._last_decision.clear()
+        self._decision_step.clear()
         
         for router in self.routers.values():
             router.reset_stats()
         
         for layer_stats in self.expert_compression_stats.values():
-            layer_stats["expert_usage"].zero_()
-            layer_stats["compression_ratios"].zero_()
-            layer_stats["cache_hit_rates"].zero_()
+            layer_stats.zero_()
     
-    def forward_hook(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
-        """
-        重写forward_hook方法以支持GPT2和其他模型
-        """
-        # 检测模型类型并提取参数
-        if isinstance(module, torch.nn.Module) and hasattr(module, '_model_type'):
-            # GPT2模型：参数在input中
-            if module._model_type == 'gpt2':
-                hidden_states = input[0] if input else None
-                # GPT2可能没有past_key_value，需要特殊处理
-                if len(input) > 1 and input[1] is not None:
-                    cache = input[1]
-                else:
-                    # 如果没有缓存，直接返回
-                    return output
-            else:
-                # 其他模型：参数在kwargs中
-                hidden_states = kwargs.get("hidden_states")
-                cache = kwargs.get("past_key_value")
-        else:
-            # 默认尝试从kwargs获取
-            hidden_states = kwargs.get("hidden_states")
-            cache = kwargs.get("past_key_value")
-        
-        # 如果没有hidden_states，尝试从input获取
+    def _hook_gpt2(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
+        """GPT2专用hook：hidden_states和缓存的位置在注册时已知，直接按位取参"""
+        hidden_states = input[0] if input else None
+        cache = input[1] if len(input) > 1 else None
+        if hidden_states is None or cache is None:
+            # GPT2可能没有past_key_value，直接返回
+            return output
+        return self._compress_and_update(module, hidden_states, cache, kwargs, output)
+
+    def _hook_default(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
+        """Llama/Mistral等模型的hook：参数在kwargs中"""
+        hidden_states = kwargs.get("hidden_states")
         if hidden_states is None and input:
             hidden_states = input[0]
-        
-        # 如果仍然没有hidden_states，直接返回
-        if hidden_states is None:
+        cache = kwargs.get("past_key_value")
+        if hidden_states is None or cache is None:
             return output
-        
-        # 如果没有缓存，直接返回
-        if cache is None:
-            return output
-        
-        q_len = hidden_states.shape[1]
-        
+        return self._compress_and_update(module, hidden_states, cache, kwargs, output)
+
+    def _compress_and_update(
+        self, module: nn.Module, hidden_states: torch.Tensor, cache, kwargs: dict, output: list
+    ):
+        """两个专用hook的公共路径：取KV、压缩、写回缓存
+
+        配合transformers的QuantizedCache使用时，保留下来的token以逐通道
+        量化形式（如INT8）驻留缓存：读取时反量化、写回时重量化，在token
+        驱逐之外再省一半显存与后续注意力读K/V的带宽。
+        """
         # 检查是否需要压缩（简化版本，不检查cache_position）
-        # 对于GPT2，我们总是尝试压缩
-        
-        # 获取缓存
-        if hasattr(cache, 'key_cache') and hasattr(cache, 'value_cache'):
-            # 标准缓存格式
+        if isinstance(cache, QuantizedCache):
+            keys = cache._dequantize(cache._quantized_key_cache[module.layer_idx])
+            values = cache._dequantize(cache._quantized_value_cache[module.layer_idx])
+        elif hasattr(cache, 'key_cache') and hasattr(cache, 'value_cache'):
             keys = cache.key_cache[module.layer_idx]
             values = cache.value_cache[module.layer_idx]
         else:
-            # 可能是其他格式，直接返回
+            # 可能是其他缓存格式，直接返回
             return output
-        
+
         # 执行压缩
-        keys, values = self.compress(module, hidden_states, keys, values, output[1] if len(output) > 1 else None, kwargs)
-        
+        keys, values = self.compress(
+            module, hidden_states, keys, values, output[1] if len(output) > 1 else None, kwargs
+        )
+
         # 更新缓存
-        cache.key_cache[module.layer_idx] = keys
-        cache.value_cache[module.layer_idx] = values
-        
+        if isinstance(cache, QuantizedCache):
+            cache._quantized_key_cache[module.layer_idx] = cache._quantize(keys, axis=cache.axis_key)
+            cache._quantized_value_cache[module.layer_idx] = cache._quantize(values, axis=cache.axis_value)
+            cache.key_cache[module.layer_idx] = torch.zeros(0, dtype=keys.dtype, device=keys.device)
+            cache.value_cache[module.layer_idx] = torch.zeros(0, dtype=keys.dtype, device=keys.device)
+            cache._seen_tokens = keys.shape[2]
+        else:
+            cache.key_cache[module.layer_idx] = keys
+            cache.value_cache[module.layer_idx] = values
+
         return output
+
+    def forward_hook(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
+        """
+        通用入口，保留以兼容直接调用；__call__注册的是按模型类型特化的hook，
+        模型类型探测只在注册时发生一次，不在每层每token的热路径上
+        """
+        if getattr(module, '_model_type', None) == 'gpt2':
+            return self._hook_gpt2(module, input, kwargs, output)
+        return self._hook_default(module, input, kwargs, output)
     
     @contextmanager
     def __call__(self, model: PreTrainedModel):
@@ -1209,15 +1647,15 @@ class MoERouterPress(BasePress):
                     layer.layer_idx = i
                     # 标记模型类型
                     layer.attn._model_type = 'gpt2'
-                    # 注册到注意力层
-                    hooks.append(layer.attn.register_forward_hook(self.forward_hook, with_kwargs=True))
+                    # 注册到注意力层（GPT2专用hook，注册时即完成模型类型分派）
+                    hooks.append(layer.attn.register_forward_hook(self._hook_gpt2, with_kwargs=True))
             else:
                 # 其他模型（Llama, Mistral等）
                 layers = model.model.layers
                 for i, layer in enumerate(layers):
                     layer.layer_idx = i
                     # 注册到注意力层
-                    hooks.append(layer.self_attn.register_forward_hook(self.forward_hook, with_kwargs=True))
+                    hooks.append(layer.self_attn.register_forward_hook(self._hook_default, with_kwargs=True))
             
             yield
             
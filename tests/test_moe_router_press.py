@@ -13,7 +13,8 @@ from unittest.mock import Mock, patch
 from kvpress.presses.moe_router_press import (
     BaseMoERouter, 
     PiKVMoERouter, 
-    MoERouterPress
+    MoERouterPress,
+    _groupwise_quant_sim
 )
 
 
@@ -57,12 +58,15 @@ class TestBaseMoERouter:
         hidden_states = torch.randn(batch_size, seq_len, 512)
         
         # 前向传播
-        dispatch_tensor, combine_tensor, router_probs, aux_loss = router(hidden_states)
-        
-        # 检查输出形状
+        dispatch, combine_weights, router_probs, aux_loss = router(hidden_states)
+
+        # 检查输出形状（ragged布局：token索引 + 每个专家的区间偏移）
         capacity = router._compute_capacity(batch_size, seq_len)
-        assert dispatch_tensor.shape == (batch_size, seq_len, 4, capacity)
-        assert combine_tensor.shape == (batch_size, seq_len, 4, capacity)
+        assert dispatch.offsets.shape == (4 + 1,)
+        assert dispatch.token_ids.shape == combine_weights.shape
+        assert dispatch.token_ids.numel() <= batch_size * seq_len * 2  # top_k=2
+        # 每个专家的分配数不超过容量
+        assert torch.all(dispatch.offsets[1:] - dispatch.offsets[:-1] <= capacity)
         assert router_probs.shape == (batch_size, seq_len, 4)
         assert isinstance(aux_loss, torch.Tensor)
         
@@ -170,19 +174,19 @@ class TestPiKVMoERouter:
         
         # 前向传播 - PiKVMoERouter返回5个值
         hidden_states = torch.randn(2, 10, 512)
-        dispatch_tensor, combine_tensor, router_probs, aux_loss, importance = router(hidden_states)
-        
-        # 验证输出形状 - 使用实际输出而不是硬编码期望值
-        assert dispatch_tensor.shape == combine_tensor.shape
-        assert dispatch_tensor.shape[:3] == (2, 10, 4)  # batch, seq, experts
+        dispatch, combine_weights, router_probs, aux_loss, importance = router(hidden_states)
+
+        # 验证输出形状 - ragged布局：token索引与组合权重对齐
+        assert dispatch.token_ids.shape == combine_weights.shape
+        assert dispatch.offsets.shape == (4 + 1,)
         assert router_probs.shape == (2, 10, 4)
         assert isinstance(aux_loss, torch.Tensor)
         assert importance.shape == (2, 10)  # 重要性分数
-        
-        # 验证容量是合理的
-        capacity = dispatch_tensor.shape[3]
-        assert capacity > 0
-        assert capacity <= router._compute_capacity(2, 10)  # 不应该超过最大容量
+
+        # 验证每个专家的分配不超过容量
+        segment_sizes = dispatch.offsets[1:] - dispatch.offsets[:-1]
+        assert torch.all(segment_sizes >= 0)
+        assert torch.all(segment_sizes <= router._compute_capacity(2, 10))
 
 
 class TestMoERouterPress:
@@ -202,7 +206,7 @@ class TestMoERouterPress:
         assert press.router_type == "pikv"
         assert press.cache_aware == True
         assert len(press.expert_strategies) == 4
-        assert press.routers == {}
+        assert len(press.routers) == 0
     
     def test_get_router(self):
         """测试路由器获取"""
@@ -216,8 +220,8 @@ class TestMoERouterPress:
         assert router.num_experts == 4
         
         # 检查是否缓存了路由器
-        assert 0 in press.routers
-        assert press.routers[0] is router
+        assert "0" in press.routers
+        assert press.routers["0"] is router
     
     def test_get_router_base_type(self):
         """测试基础路由器类型"""
@@ -305,6 +309,128 @@ class TestMoERouterPress:
         assert press.forward_count == 1
         assert press.total_aux_loss > 0
     
+    def test_selective_compression_long_context_kthvalue(self):
+        """测试超长上下文选择路径（kthvalue阈值+并列截断）"""
+        press = MoERouterPress(num_experts=4, compression_ratio=0.5)
+        
+        seq_len = 5000
+        num_keep = int(seq_len * 0.5)
+        keys = torch.randn(1, 2, seq_len, 8)
+        values = torch.randn(1, 2, seq_len, 8)
+        
+        # 递增的注意力分数：应精确保留最后num_keep个位置
+        attentions = torch.arange(seq_len, dtype=torch.float32).view(1, 1, 1, seq_len)
+        compressed_keys, compressed_values = press._apply_selective_compression(
+            keys, values, None, attentions
+        )
+        assert compressed_keys.shape[2] == num_keep
+        assert torch.equal(compressed_keys, keys[:, :, seq_len - num_keep:])
+        assert torch.equal(compressed_values, values[:, :, seq_len - num_keep:])
+        
+        # 阈值上并列的位置多于num_keep个：截断后保留最靠前的num_keep个
+        tied_scores = torch.zeros(1, 1, 1, seq_len)
+        tied_scores[..., :3000] = 1.0
+        compressed_keys, compressed_values = press._apply_selective_compression(
+            keys, values, None, tied_scores
+        )
+        assert compressed_keys.shape[2] == num_keep
+        assert torch.equal(compressed_keys, keys[:, :, :num_keep])
+        assert torch.equal(compressed_values, values[:, :, :num_keep])
+    
+    def test_groupwise_quant_sim(self):
+        """测试分组量化模拟"""
+        x = torch.randn(2, 8, 10, 64)
+        
+        # bits>=16时原样返回
+        assert _groupwise_quant_sim(x, 16) is x
+        
+        # 4bit：重建误差不超过一个量化步长（head_dim=64恰为一组）
+        quantized = _groupwise_quant_sim(x, 4)
+        step = (x.amax(dim=-1, keepdim=True) - x.amin(dim=-1, keepdim=True)) / 15
+        assert quantized.shape == x.shape
+        assert torch.all((quantized - x).abs() <= step + 1e-6)
+        
+        # 位宽越高误差越小
+        q8 = _groupwise_quant_sim(x, 8)
+        assert (q8 - x).abs().max() <= (quantized - x).abs().max() + 1e-6
+    
+    def test_compress_with_quantize_retained_kv(self):
+        """测试驱逐+量化混合压缩"""
+        press = MoERouterPress(num_experts=4, router_type="base", quantize_retained_kv=True)
+        
+        mock_module = Mock()
+        mock_module.layer_idx = 0
+        
+        hidden_states = torch.randn(2, 10, 512)
+        keys = torch.randn(2, 8, 100, 64)
+        values = torch.randn(2, 8, 100, 64)
+        attentions = torch.randn(2, 8, 10, 100)
+        kwargs = {}
+        
+        compressed_keys, compressed_values = press.compress(
+            mock_module, hidden_states, keys, values, attentions, kwargs
+        )
+        
+        # 驱逐照常发生，量化不改变形状与dtype
+        assert compressed_keys.shape[2] <= keys.shape[2]
+        assert compressed_keys.dtype == keys.dtype
+        assert compressed_values.dtype == values.dtype
+    
+    def test_decision_interval_stickiness(self):
+        """测试路由决策粘滞：间隔步复用上次决策，到步后重新路由"""
+        press = MoERouterPress(num_experts=4, router_type="base", decision_interval=2)
+        
+        mock_module = Mock()
+        mock_module.layer_idx = 0
+        
+        hidden_states = torch.randn(2, 10, 512)
+        keys = torch.randn(2, 8, 100, 64)
+        values = torch.randn(2, 8, 100, 64)
+        attentions = torch.randn(2, 8, 10, 100)
+        kwargs = {}
+        
+        # 第0步：执行路由
+        press.compress(mock_module, hidden_states, keys, values, attentions, kwargs)
+        assert press.forward_count == 1
+        assert 0 in press._last_decision
+        
+        # 固定为比例策略，排除随机选中selective（selective不参与粘滞）
+        press._last_decision[0] = (1, "moderate")
+        
+        # 第1步：命中粘滞窗口，路由器前向被跳过
+        press.compress(mock_module, hidden_states, keys, values, attentions, kwargs)
+        assert press.forward_count == 1
+        
+        # 第2步：到达decision_interval，重新路由
+        press.compress(mock_module, hidden_states, keys, values, attentions, kwargs)
+        assert press.forward_count == 2
+    
+    def test_decision_interval_selective_and_reset(self):
+        """测试selective策略始终重路由，reset_stats清空粘滞状态"""
+        press = MoERouterPress(num_experts=4, router_type="base", decision_interval=4)
+        
+        mock_module = Mock()
+        mock_module.layer_idx = 0
+        
+        hidden_states = torch.randn(2, 10, 512)
+        keys = torch.randn(2, 8, 100, 64)
+        values = torch.randn(2, 8, 100, 64)
+        attentions = torch.randn(2, 8, 10, 100)
+        kwargs = {}
+        
+        # 预置粘滞状态：上次决策为selective，本步本应复用
+        press._last_decision[0] = (3, "selective")
+        press._decision_step[0] = 1
+        
+        # selective依赖当前router_probs，必须重新路由
+        press.compress(mock_module, hidden_states, keys, values, attentions, kwargs)
+        assert press.forward_count == 1
+        
+        # 重置后粘滞状态被清空
+        press.reset_stats()
+        assert press._last_decision == {}
+        assert press._decision_step == {}
+    
     def test_get_stats(self):
         """测试获取统计信息"""
         press = MoERouterPress(num_experts=4)
@@ -361,7 +487,7 @@ class TestMoERouterPress:
         assert press.total_aux_loss == 0.0
         
         # 检查路由器统计是否重置
-        router = press.routers[0]
+        router = press.routers["0"]
         stats = router.get_routing_stats()
         assert stats["total_tokens"].item() == 0
 